@@ -2,8 +2,14 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import altair as alt
 import io # Necessário para ler o uploaded_file como buffer
-from typing import Dict, Any, Optional, Tuple # Importar Tuple para type hints
+import csv # csv.Sniffer para adivinhar o delimitador
+import logging
+from typing import Dict, Any, List, Optional, Tuple # Importar Tuple para type hints
+
+# Tracebacks completos ficam no log do servidor; a interface mostra só a mensagem
+logger = logging.getLogger(__name__)
 
 # Importar biblioteca HPLC
 # Verificar se a biblioteca está disponível no início
@@ -18,6 +24,306 @@ except ImportError:
     st.error("⚠️ Biblioteca HPLC não encontrada. Por favor instale: pip install hplc")
     st.info("⚠️ Algumas funcionalidades (detecção e análise de picos) não estarão disponíveis sem a biblioteca HPLC.")
 
+# Motor de leitura de CSV: PyArrow (multi-thread) se estiver instalado, senão o motor C do pandas
+try:
+    import pyarrow
+    CSV_ENGINE_OPTIONS: Dict[str, Any] = {'engine': 'pyarrow'}
+except ImportError:
+    CSV_ENGINE_OPTIONS = {'engine': 'c', 'low_memory': False, 'cache_dates': True}
+
+# Detetor de encoding opcional, usado quando a amostra não é UTF-8 válido
+try:
+    from charset_normalizer import from_bytes as detect_charset
+except ImportError:
+    detect_charset = None
+
+# Tamanho da amostra (bytes) usada para detetar o encoding
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# Encodings considerados pelo charset_normalizer (codificações da Europa Ocidental)
+PLAUSIBLE_ENCODINGS = ['latin_1', 'iso8859_15', 'cp850']
+
+# Fração mínima de bytes NUL nas posições pares/ímpares para assumir UTF-16 sem BOM
+UTF16_NUL_RATIO = 0.3
+
+@st.cache_data(show_spinner=False)
+def detect_encoding(file_id: str, _raw: bytes) -> str:
+    """
+    Detetar o encoding do ficheiro a partir de uma amostra inicial (resultado em cache).
+
+    Args:
+        file_id: Identificador do ficheiro carregado (chave da cache).
+        _raw: Conteúdo do ficheiro carregado, em bytes (não entra na chave da cache).
+
+    Returns:
+        Nome do encoding a usar em pd.read_csv.
+    """
+    # Marcas BOM no início do ficheiro
+    if _raw.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    if _raw.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return 'utf-16'
+
+    sample = _raw[:ENCODING_SAMPLE_SIZE]
+
+    # UTF-16 sem BOM: texto ASCII em UTF-16 tem um NUL em cada par de bytes, e isso também é UTF-8/cp1252 "válido"
+    half_length = len(sample) // 2
+    if half_length:
+        if sample[1::2].count(0) >= UTF16_NUL_RATIO * half_length:
+            return 'utf-16-le'
+        if sample[::2].count(0) >= UTF16_NUL_RATIO * half_length:
+            return 'utf-16-be'
+
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # Um carácter multibyte cortado no fim da amostra não invalida o UTF-8
+        if len(_raw) > len(sample) and e.start >= len(sample) - 3:
+            return 'utf-8'
+
+    # Exportações de instrumentos não-UTF-8 são quase sempre Windows-1252/latin1 (acentos, 'µ', '°')
+    try:
+        sample.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        pass
+
+    # O detetor só escolhe entre encodings plausíveis: sem restrição confunde latin1 com cp1006, big5, ...
+    if detect_charset is not None:
+        best_match = detect_charset(sample, cp_isolation=PLAUSIBLE_ENCODINGS).best()
+        if best_match is not None:
+            return best_match.encoding
+
+    # 'latin1' é comum para dados de instrumentos e aceita qualquer sequência de bytes
+    return 'latin1'
+
+# Delimitadores suportados, pela ordem apresentada no selectbox
+DELIMITERS = [',', ';', '\t', ' ']
+
+# Tamanho da amostra (bytes) usada para adivinhar o delimitador
+DELIMITER_SAMPLE_SIZE = 8192
+
+@st.cache_data(show_spinner=False)
+def sniff_delimiter(raw_prefix: bytes, encoding: str) -> str:
+    """
+    Adivinhar o delimitador a partir do início do ficheiro (resultado em cache).
+
+    Args:
+        raw_prefix: Primeiros bytes do ficheiro carregado.
+        encoding: Encoding do ficheiro (ver detect_encoding).
+
+    Returns:
+        Um dos DELIMITERS; ',' se não for possível determinar.
+    """
+    sample = raw_prefix.decode(encoding, errors='replace')
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=''.join(DELIMITERS))
+    except csv.Error:
+        return ','
+    return dialect.delimiter if dialect.delimiter in DELIMITERS else ','
+
+@st.cache_data(show_spinner=False)
+def load_csv_preview(file_id: str, _raw: bytes, delimiter: str, encoding: str, nrows: int = 10) -> pd.DataFrame:
+    """
+    Ler apenas o cabeçalho e as primeiras linhas do ficheiro (resultado em cache).
+
+    Args:
+        file_id: Identificador do ficheiro carregado (chave da cache).
+        _raw: Conteúdo do ficheiro carregado, em bytes (não entra na chave da cache).
+        delimiter: Delimitador usado no ficheiro.
+        encoding: Encoding do ficheiro (ver detect_encoding).
+        nrows: Número de linhas de dados a ler.
+
+    Returns:
+        DataFrame com as primeiras linhas do ficheiro.
+    """
+    # O motor PyArrow não suporta nrows; para poucas linhas o motor C é suficiente
+    return pd.read_csv(io.BytesIO(_raw), delimiter=delimiter, encoding=encoding, nrows=nrows)
+
+# Nomes atribuídos às colunas de ficheiros numéricos sem cabeçalho (tempo, sinal)
+HEADERLESS_COLUMNS = ['time', 'signal']
+
+# Número de linhas inspecionadas para detetar ficheiros numéricos sem cabeçalho
+HEADERLESS_SAMPLE_LINES = 10
+
+def split_fields(line: str, delimiter: str) -> List[str]:
+    """Separar uma linha nos seus campos (o espaço aceita espaços repetidos, como no np.loadtxt)."""
+    return line.split() if delimiter == ' ' else line.split(delimiter)
+
+def is_float(token: str) -> bool:
+    """Indicar se o texto representa um número."""
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+@st.cache_data(show_spinner=False)
+def is_headerless_numeric(file_id: str, _raw: bytes, delimiter: str, encoding: str) -> bool:
+    """
+    Detetar ficheiros só com duas colunas numéricas (tempo, sinal) e sem cabeçalho (resultado em cache).
+
+    Args:
+        file_id: Identificador do ficheiro carregado (chave da cache).
+        _raw: Conteúdo do ficheiro carregado, em bytes (não entra na chave da cache).
+        delimiter: Delimitador usado no ficheiro.
+        encoding: Encoding do ficheiro (ver detect_encoding).
+
+    Returns:
+        True se as primeiras linhas tiverem exatamente dois campos numéricos.
+    """
+    sample = _raw[:DELIMITER_SAMPLE_SIZE].decode(encoding, errors='replace')
+    lines = sample.splitlines()
+    if len(_raw) > DELIMITER_SAMPLE_SIZE:
+        lines = lines[:-1] # A última linha da amostra pode estar cortada
+    lines = [line for line in lines[:HEADERLESS_SAMPLE_LINES] if line.strip()]
+    if not lines:
+        return False
+
+    for line in lines:
+        fields = split_fields(line.strip(), delimiter)
+        if len(fields) != 2 or not all(is_float(field) for field in fields):
+            return False
+    return True
+
+def is_ascii_compatible(encoding: str) -> bool:
+    """Indicar se o encoding guarda quebras de linha, separadores e dígitos como bytes ASCII (UTF-8, cp1252, ...; não UTF-16)."""
+    ascii_text = '0123456789.,;\t \r\n'
+    # endswith: ignora o BOM que alguns encodings (utf-8-sig) acrescentam
+    return ascii_text.encode(encoding).endswith(ascii_text.encode('ascii'))
+
+@st.cache_data(show_spinner=False)
+def load_headerless_numeric(file_id: str, _raw: bytes, delimiter: str, encoding: str, max_rows: Optional[int] = None) -> pd.DataFrame:
+    """
+    Ler um ficheiro numérico de duas colunas sem cabeçalho com np.loadtxt, sem a inferência de tipos do pandas (resultado em cache).
+
+    Args:
+        file_id: Identificador do ficheiro carregado (chave da cache).
+        _raw: Conteúdo do ficheiro carregado, em bytes (não entra na chave da cache).
+        delimiter: Delimitador usado no ficheiro.
+        encoding: Encoding do ficheiro (ver detect_encoding).
+        max_rows: Número máximo de linhas a ler (None para ler todas).
+
+    Returns:
+        DataFrame float64 com as colunas HEADERLESS_COLUMNS.
+    """
+    # np.loadtxt separa as linhas no byte '\n' antes de descodificar: em UTF-16 é preciso descodificar primeiro
+    source = io.BytesIO(_raw) if is_ascii_compatible(encoding) else io.StringIO(_raw.decode(encoding))
+    values = np.loadtxt(
+        source,
+        delimiter=None if delimiter == ' ' else delimiter, # None: qualquer sequência de espaços
+        dtype=np.float64,
+        usecols=(0, 1),
+        max_rows=max_rows,
+        encoding=encoding,
+        ndmin=2
+    )
+    return pd.DataFrame(values, columns=HEADERLESS_COLUMNS)
+
+def count_data_rows(raw: bytes, encoding: str) -> int:
+    """
+    Estimar o número de linhas de dados contando quebras de linha (sem fazer parse).
+
+    Args:
+        raw: Conteúdo do ficheiro carregado, em bytes.
+        encoding: Encoding do ficheiro (ver detect_encoding).
+
+    Returns:
+        Número de linhas, excluindo o cabeçalho.
+    """
+    # Em encodings compatíveis com ASCII basta contar bytes; em UTF-16 o '\n' ocupa dois bytes
+    content = raw if is_ascii_compatible(encoding) else raw.decode(encoding, errors='replace')
+    newline = b'\n' if isinstance(content, bytes) else '\n'
+    n_lines = content.count(newline)
+    if content and not content.endswith(newline):
+        n_lines += 1 # Última linha sem quebra de linha final
+    return max(n_lines - 1, 0)
+
+def guess_default_columns(available_columns: List[str]) -> Tuple[int, int]:
+    """
+    Tentar pré-selecionar as colunas de tempo e sinal a partir de nomes comuns.
+
+    Args:
+        available_columns: Nomes das colunas do ficheiro.
+
+    Returns:
+        Uma tupla (índice da coluna de tempo, índice da coluna de sinal).
+    """
+    default_time_col_index = 0
+    if 'time' in available_columns:
+         default_time_col_index = available_columns.index('time')
+    elif 'tempo' in available_columns:
+         default_time_col_index = available_columns.index('tempo')
+
+    default_signal_col_index = 1 if len(available_columns) > 1 else 0
+    if 'signal' in available_columns:
+         default_signal_col_index = available_columns.index('signal')
+    elif 'sinal' in available_columns:
+         default_signal_col_index = available_columns.index('sinal')
+    elif 'intensity' in available_columns:
+         default_signal_col_index = available_columns.index('intensity')
+
+    return default_time_col_index, default_signal_col_index
+
+def open_raw_buffer(raw: bytes) -> Any:
+    """
+    Criar um leitor sobre os bytes do ficheiro para pd.read_csv, sem copiar o conteúdo.
+
+    Args:
+        raw: Conteúdo do ficheiro carregado, em bytes.
+
+    Returns:
+        pyarrow.BufferReader com o motor PyArrow (lido diretamente em C, sem chamadas read() em Python),
+        caso contrário io.BytesIO.
+    """
+    if CSV_ENGINE_OPTIONS['engine'] == 'pyarrow':
+        return pyarrow.BufferReader(pyarrow.py_buffer(raw))
+    return io.BytesIO(raw)
+
+@st.cache_data(show_spinner=False)
+def load_full_csv(file_id: str, _raw: bytes, delimiter: str, encoding: str, usecols: Optional[Tuple[str, ...]] = None) -> pd.DataFrame:
+    """
+    Ler o ficheiro completo para um DataFrame (resultado em cache).
+
+    Args:
+        file_id: Identificador do ficheiro carregado (chave da cache).
+        _raw: Conteúdo do ficheiro carregado, em bytes (não entra na chave da cache).
+        delimiter: Delimitador usado no ficheiro.
+        encoding: Encoding do ficheiro (ver detect_encoding).
+        usecols: Colunas a ler, todas convertidas para float64 (None para ler todas as colunas).
+
+    Returns:
+        DataFrame com os dados do ficheiro.
+    """
+    read_kwargs: Dict[str, Any] = dict(CSV_ENGINE_OPTIONS)
+    if usecols is not None:
+        read_kwargs['usecols'] = list(usecols)
+        read_kwargs['dtype'] = {col: 'float64' for col in usecols}
+
+    return pd.read_csv(open_raw_buffer(_raw), delimiter=delimiter, encoding=encoding, **read_kwargs)
+
+def show_error(message: str, e: Exception) -> None:
+    """
+    Mostrar um erro curto na interface e registar o traceback no log do servidor (chamar dentro de um bloco except).
+
+    Args:
+        message: Descrição do erro a mostrar.
+        e: Exceção capturada.
+    """
+    logger.exception(message)
+    st.error(f"❌ {message}: {str(e)}")
+    # O traceback só é enviado para o browser se o utilizador o pedir
+    if st.session_state.get("show_technical_details_checkbox", False):
+        st.exception(e)
+
+# Fatores de conversão para minutos de cada unidade de tempo suportada
+TIME_UNIT_TO_MINUTES: Dict[str, float] = {
+    "Segundos": 1 / 60.0,
+    "Milissegundos": 1 / 60000.0,
+    "Minutos": 1.0,
+}
+
 def convert_time_to_minutes(data: pd.DataFrame, time_col: str, time_unit: str) -> pd.DataFrame:
     """
     Converter coluna de tempo para minutos.
@@ -25,31 +331,202 @@ def convert_time_to_minutes(data: pd.DataFrame, time_col: str, time_unit: str) -
     Args:
         data: DataFrame pandas contendo os dados do cromatograma.
         time_col: Nome da coluna de tempo.
-        time_unit: Unidade atual da coluna de tempo ("Segundos", "Minutos", "Horas").
+        time_unit: Unidade atual da coluna de tempo ("Segundos", "Minutos", "Milissegundos").
 
     Returns:
-        DataFrame com a coluna de tempo convertida para minutos.
-    """
-    # Usamos .loc para evitar SettingWithCopyWarning
-    data_copy = data.copy()
-
-    if time_unit == "Segundos":
-        data_copy.loc[:, time_col] = data_copy[time_col].apply(lambda x: x / 60)
-        st.info("✅ Tempo convertido de segundos para minutos")
-    elif time_unit == "Milisegundos":
-        data_copy.loc[:, time_col] = data_copy[time_col].apply(lambda x: x / 60000)
-        st.info("✅ Tempo convertido de milissegundos para minutos")
-    elif time_unit == "Minutos":
-        st.info("✅ Tempo já está em minutos")
-    # Adicionar um else para unidades desconhecidas, embora o selectbox limite as opções
-    else:
-         st.warning(f"Unidade de tempo desconhecida: {time_unit}. Nenhuma conversão aplicada.")
+        DataFrame com a coluna de tempo convertida para minutos (o próprio DataFrame recebido se não houver conversão).
+    """
+    factor = TIME_UNIT_TO_MINUTES.get(time_unit)
+    # Unidades desconhecidas, embora o selectbox limite as opções
+    if factor is None:
+        st.warning(f"Unidade de tempo desconhecida: {time_unit}. Nenhuma conversão aplicada.")
+        return data
+
+    # Já em minutos: devolver o próprio DataFrame, sem qualquer alocação
+    if factor == 1.0:
+        return data
 
+    # Cópia superficial: apenas a coluna de tempo é substituída, as restantes são partilhadas
+    data_copy = data.copy(deep=False)
+    data_copy[time_col] = data_copy[time_col].to_numpy(dtype=np.float64, copy=False) * factor
 
     return data_copy
 
+# Acima deste número de pontos o traçado é reduzido antes de ser desenhado
+PLOT_DECIMATION_THRESHOLD = 4000
+# Número de intervalos (aprox. colunas de píxeis) mantidos após a redução
+PLOT_DECIMATION_BINS = 2000
+
+def decimate_min_max(time_values: np.ndarray, signal_values: np.ndarray, n_bins: int = PLOT_DECIMATION_BINS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduzir o traçado a um par mínimo/máximo por intervalo, para desenhar sinais longos.
+
+    Sem cache: calcular a redução (reduceat vetorizado) é mais rápido do que o hash dos arrays completos.
+
+    Args:
+        time_values: Valores de tempo, por ordem.
+        signal_values: Valores de sinal correspondentes (len(signal_values) >= n_bins).
+        n_bins: Número de intervalos.
+
+    Returns:
+        Uma tupla (tempo, sinal) com 2 * n_bins pontos, visualmente equivalente ao traçado original.
+    """
+    starts = np.linspace(0, len(signal_values), n_bins, endpoint=False).astype(np.intp)
+    signal_min = np.minimum.reduceat(signal_values, starts)
+    signal_max = np.maximum.reduceat(signal_values, starts)
+
+    # Cada intervalo é desenhado como um segmento vertical no tempo do seu primeiro ponto
+    decimated_time = np.repeat(time_values[starts], 2)
+    decimated_signal = np.column_stack((signal_min, signal_max)).ravel()
+    return decimated_time, decimated_signal
+
+def hash_dataframe(df: pd.DataFrame) -> Tuple[Tuple[Any, ...], bytes]:
+    """
+    Calcular uma chave de cache a partir do conteúdo do DataFrame (e não da sua identidade).
+
+    Args:
+        df: DataFrame a identificar.
+
+    Returns:
+        Uma tupla com os nomes das colunas e o hash dos valores.
+    """
+    return tuple(df.columns), pd.util.hash_pandas_object(df, index=False).values.tobytes()
+
+# hash_funcs partilhado pelas funções em cache que recebem DataFrames
+DATAFRAME_HASH_FUNCS = {pd.DataFrame: hash_dataframe}
+
+# Número máximo de resultados de fit_peaks mantidos em cache
+FIT_CACHE_MAX_ENTRIES = 32
+
+def to_contiguous_float64(data_df: pd.DataFrame, columns: Tuple[str, ...]) -> pd.DataFrame:
+    """
+    Preparar as colunas para o fit_peaks como arrays float64 C-contíguos, evitando conversões escondidas dentro da biblioteca.
+
+    Args:
+        data_df: DataFrame pandas contendo os dados processados.
+        columns: Colunas a manter.
+
+    Returns:
+        DataFrame só com as colunas pedidas e índice 0..N-1; colunas que já cumprem o formato não são copiadas.
+    """
+    columns = tuple(dict.fromkeys(columns)) # Sem duplicados (tempo e sinal podem ser a mesma coluna)
+    fit_df = data_df[list(columns)].reset_index(drop=True)
+    for col in columns:
+        values = fit_df[col].to_numpy()
+        if values.dtype != np.float64 or not values.flags['C_CONTIGUOUS']:
+            fit_df[col] = np.ascontiguousarray(values, dtype=np.float64)
+    return fit_df
+
+@st.cache_data(show_spinner=False, hash_funcs=DATAFRAME_HASH_FUNCS, max_entries=FIT_CACHE_MAX_ENTRIES)
+def fit_peaks_cached(data_df: pd.DataFrame, time_col: str, signal_col: str, params: Tuple[Tuple[str, Any], ...]) -> pd.DataFrame:
+    """
+    Aplicar fit_peaks a um novo objeto Chromatogram (resultado em cache por dados e parâmetros).
+
+    O objeto é criado em cada chamada: fit_peaks altera-o (p.ex. a correção da linha de base),
+    pelo que não pode ser reutilizado entre ajustes com parâmetros diferentes.
+
+    Args:
+        data_df: DataFrame pandas contendo os dados processados (tempo em minutos).
+        time_col: Nome da coluna de tempo.
+        signal_col: Nome da coluna de sinal.
+        params: Parâmetros de fit_peaks como tuplo de pares (nome, valor).
+
+    Returns:
+        DataFrame com os picos encontrados.
+    """
+    # A biblioteca espera o DataFrame e um dict de colunas.
+    cromatograma = Chromatogram(data_df, cols={'time': time_col, 'signal': signal_col})
+    return cromatograma.fit_peaks(**dict(params))
+
+# Colunas da tabela devolvida por fit_peaks com a posição e a altura de cada pico
+PEAK_TIME_COL = 'retention_time'
+PEAK_HEIGHT_COL = 'signal_maximum'
+
+def has_peak_positions(dados_picos: pd.DataFrame) -> bool:
+    """Indicar se o DataFrame de picos tem as colunas necessárias para marcar os picos no gráfico."""
+    return not dados_picos.empty and PEAK_TIME_COL in dados_picos.columns and PEAK_HEIGHT_COL in dados_picos.columns
+
+def plot_chromatogram_altair(time_values: np.ndarray, signal_values: np.ndarray, dados_picos: pd.DataFrame, x_label: str, y_label: str) -> alt.TopLevelMixin:
+    """
+    Criar o gráfico interativo do cromatograma (desenhado no browser).
+
+    Args:
+        time_values: Valores de tempo a desenhar.
+        signal_values: Valores de sinal a desenhar.
+        dados_picos: DataFrame com os picos detetados (pode estar vazio).
+        x_label: Título do eixo do tempo.
+        y_label: Título do eixo do sinal.
+
+    Returns:
+        Gráfico Altair com o traçado e, se existirem, os picos.
+    """
+    # Nomes de campos fixos: os nomes das colunas do ficheiro podem ter caracteres especiais para o Vega-Lite
+    plot_df = pd.DataFrame({'tempo': time_values, 'sinal': signal_values})
+    chart = alt.Chart(plot_df).mark_line(color='blue', strokeWidth=1).encode(
+        x=alt.X('tempo:Q', title=x_label),
+        y=alt.Y('sinal:Q', title=y_label)
+    )
+
+    if has_peak_positions(dados_picos):
+        peaks_df = dados_picos[[PEAK_TIME_COL, PEAK_HEIGHT_COL]]
+        peak_points = alt.Chart(peaks_df).mark_point(color='red', filled=True, size=40).encode(
+            x=f'{PEAK_TIME_COL}:Q',
+            y=f'{PEAK_HEIGHT_COL}:Q',
+            tooltip=[PEAK_TIME_COL, PEAK_HEIGHT_COL]
+        )
+        peak_rules = alt.Chart(peaks_df).mark_rule(color='red', strokeDash=[2, 2], strokeWidth=0.8).encode(
+            x=f'{PEAK_TIME_COL}:Q',
+            y=alt.datum(0),
+            y2=f'{PEAK_HEIGHT_COL}:Q'
+        )
+        chart = alt.layer(chart, peak_rules, peak_points)
+
+    return chart.properties(title='Cromatograma com Picos Detetados').interactive()
+
+def plot_chromatogram_matplotlib(time_values: np.ndarray, signal_values: np.ndarray, dados_picos: pd.DataFrame, x_label: str, y_label: str) -> plt.Figure:
+    """
+    Criar a figura matplotlib do cromatograma, usada para a exportação PNG de alta qualidade.
+
+    Args:
+        time_values: Valores de tempo a desenhar.
+        signal_values: Valores de sinal a desenhar.
+        dados_picos: DataFrame com os picos detetados (pode estar vazio).
+        x_label: Título do eixo do tempo.
+        y_label: Título do eixo do sinal.
+
+    Returns:
+        Figura matplotlib (o chamador deve fechá-la com plt.close).
+    """
+    fig, ax = plt.subplots(figsize=(12, 6))
+    ax.plot(time_values, signal_values, 'b-', linewidth=1)
+
+    # Se picos foram detectados, plotar os picos
+    if has_peak_positions(dados_picos):
+         ax.plot(dados_picos[PEAK_TIME_COL], dados_picos[PEAK_HEIGHT_COL], 'ro', markersize=5, label='Picos Detetados')
+         ax.vlines(dados_picos[PEAK_TIME_COL], [0], dados_picos[PEAK_HEIGHT_COL], color='red', linestyle=':', linewidth=0.8)
+         ax.legend()
+
+    ax.set_xlabel(x_label)
+    ax.set_ylabel(y_label)
+    ax.set_title('Cromatograma com Picos Detetados')
+    ax.grid(True, alpha=0.3)
+    return fig
+
+@st.cache_data(show_spinner=False, hash_funcs=DATAFRAME_HASH_FUNCS)
+def peaks_to_csv_bytes(dados_picos: pd.DataFrame) -> bytes:
+    """
+    Serializar a tabela de picos para CSV, para o botão de download (resultado em cache).
+
+    Args:
+        dados_picos: DataFrame com os picos detetados.
+
+    Returns:
+        Conteúdo CSV codificado em UTF-8.
+    """
+    return dados_picos.to_csv(index=False).encode('utf-8')
+
 # Nova função para processar com a biblioteca HPLC
-def process_chromatogram_hplc(data_df: pd.DataFrame, time_col: str, signal_col: str, params: Dict[str, Any]) -> Tuple[Optional[Chromatogram], pd.DataFrame]:
+def process_chromatogram_hplc(data_df: pd.DataFrame, time_col: str, signal_col: str, params: Dict[str, Any]) -> pd.DataFrame:
     """
     Processar cromatograma usando a biblioteca HPLC (criação de objeto Chromatogram e fit_peaks).
 
@@ -60,39 +537,35 @@ def process_chromatogram_hplc(data_df: pd.DataFrame, time_col: str, signal_col:
         params: Dicionário de parâmetros para a função fit_peaks.
 
     Returns:
-        Uma tupla contendo o objeto Chromatogram (ou None se HPLC_LIB_AVAILABLE for False)
-        e um DataFrame com os dados dos picos (vazio se não houver picos ou ocorrer erro).
+        DataFrame com os dados dos picos (vazio se a biblioteca não estiver disponível,
+        não houver picos ou ocorrer erro).
     """
     if not HPLC_LIB_AVAILABLE:
         st.error("❌ Biblioteca HPLC não está disponível. Não é possível processar picos.")
-        return None, pd.DataFrame()
+        return pd.DataFrame()
 
     try:
-        st.info("🛠️ Processando com biblioteca HPLC...")
-        # Criar objeto Chromatogram. A biblioteca espera o DataFrame e um dict de colunas.
         # Certificar-se que os nomes das colunas passados existem no DataFrame
         if time_col not in data_df.columns or signal_col not in data_df.columns:
              st.error(f"Colunas '{time_col}' ou '{signal_col}' não encontradas no DataFrame.")
-             return None, pd.DataFrame()
-
-        cromatograma = Chromatogram(data_df, cols={'time': time_col, 'signal': signal_col})
+             return pd.DataFrame()
 
-        # Aplicar fit_peaks com os parâmetros
+        # Aplicar fit_peaks com os parâmetros (em cache: só é recalculado se dados ou parâmetros mudarem)
         # fit_peaks retorna um DataFrame com os picos encontrados
-        dados_picos = cromatograma.fit_peaks(
-            correct_baseline=params['correct_baseline'],
-            approx_peak_width=params['approx_peak_width'],
-            buffer=params['buffer'],
-            prominence=params['prominence']
+        fit_params = (
+            ('correct_baseline', params['correct_baseline']),
+            ('approx_peak_width', params['approx_peak_width']),
+            ('buffer', params['buffer']),
+            ('prominence', params['prominence']),
         )
-
-        st.success("✅ Análise de picos concluída.")
-        return cromatograma, dados_picos
+        with st.status("🛠️ A detetar picos com a biblioteca HPLC...") as fit_status:
+            dados_picos = fit_peaks_cached(data_df, time_col, signal_col, fit_params)
+            fit_status.update(label="✅ Análise de picos concluída.", state="complete")
+        return dados_picos
 
     except Exception as e:
-        st.error(f"❌ Erro ao processar com biblioteca HPLC: {str(e)}")
-        st.exception(e)
-        return None, pd.DataFrame()
+        show_error("Erro ao processar com biblioteca HPLC", e)
+        return pd.DataFrame()
 
 def main():
     st.set_page_config(
@@ -109,11 +582,15 @@ def main():
 
     # Mostrar parâmetros apenas se a biblioteca HPLC estiver disponível
     params: Dict[str, Any] = {}
+    params_submitted = False
     if HPLC_LIB_AVAILABLE:
-        params['correct_baseline'] = st.sidebar.checkbox("Corrigir linha de base", value=False, key="correct_baseline_checkbox")
-        params['approx_peak_width'] = st.sidebar.slider("Largura aproximada do pico", 0.01, 5.0, 0.1, 0.01, key="peak_width_slider", help="Largura esperada dos picos em unidades de tempo (minutos).")
-        params['buffer'] = st.sidebar.slider("Buffer", 10, 500, 100, 10, key="buffer_slider", help="Número de pontos à volta de um pico para considerar na correção da linha de base.")
-        params['prominence'] = st.sidebar.slider("Prominência", 0.001, 1.0, 0.02, 0.001, key="prominence_slider", help="Proeminência mínima para detetar um pico.")
+        # Formulário: mexer nos sliders não provoca reruns; os parâmetros só são aplicados ao carregar em "Aplicar"
+        with st.sidebar.form("hplc_params"):
+            params['correct_baseline'] = st.checkbox("Corrigir linha de base", value=False, key="correct_baseline_checkbox")
+            params['approx_peak_width'] = st.slider("Largura aproximada do pico", 0.01, 5.0, 0.1, 0.01, key="peak_width_slider", help="Largura esperada dos picos em unidades de tempo (minutos).")
+            params['buffer'] = st.slider("Buffer", 10, 500, 100, 10, key="buffer_slider", help="Número de pontos à volta de um pico para considerar na correção da linha de base.")
+            params['prominence'] = st.slider("Prominência", 0.001, 1.0, 0.02, 0.001, key="prominence_slider", help="Proeminência mínima para detetar um pico.")
+            params_submitted = st.form_submit_button("Aplicar")
     else:
          st.sidebar.warning("Parâmetros de análise desabilitados (biblioteca HPLC não encontrada).")
          # Definir parâmetros padrão ou vazios se a lib não estiver disponível
@@ -124,6 +601,19 @@ def main():
              'prominence': 0.02
          }
 
+    st.sidebar.markdown("---")
+    high_quality_png = st.sidebar.checkbox(
+        "Exportação PNG de alta qualidade",
+        value=False,
+        key="high_quality_png_checkbox",
+        help="Desenha o cromatograma com matplotlib no servidor e permite transferir o gráfico em PNG. Por omissão o gráfico é interativo e desenhado no browser."
+    )
+    st.sidebar.checkbox(
+        "Mostrar detalhes técnicos",
+        value=False,
+        key="show_technical_details_checkbox",
+        help="Mostra o traceback completo dos erros na página (o traceback fica sempre registado no log do servidor)."
+    )
 
     # Upload de ficheiro
     st.header("📁 Carregar Ficheiro")
@@ -137,54 +627,53 @@ def main():
     data_df: Optional[pd.DataFrame] = None # Inicializa DataFrame como None
 
     if uploaded_file is not None:
-        # Ler o ficheiro para um buffer em memória para poder lê-lo várias vezes (preview, load total)
-        file_buffer = io.BytesIO(uploaded_file.getvalue())
+        # Copiar os bytes do ficheiro só quando é carregado um novo ficheiro (não em cada rerun);
+        # o file_id é estável entre reruns e serve de chave para as funções em cache
+        file_id = uploaded_file.file_id
+        if st.session_state.get("file_id") != file_id:
+            new_raw_bytes = uploaded_file.getvalue()
+            new_encoding = detect_encoding(file_id, new_raw_bytes)
+            st.session_state.raw_bytes = new_raw_bytes
+            st.session_state.row_count = count_data_rows(new_raw_bytes, new_encoding)
+            # Detectar delimitador (sugestão a partir do conteúdo do ficheiro); o selectbox tem key e
+            # manteria o valor do ficheiro anterior, por isso o valor sugerido é escrito no session_state
+            st.session_state.delimiter_selector = sniff_delimiter(new_raw_bytes[:DELIMITER_SAMPLE_SIZE], new_encoding)
+            st.session_state.file_id = file_id
+        raw_bytes = st.session_state.raw_bytes
+        encoding = detect_encoding(file_id, raw_bytes)
 
-        # Detectar delimitador
         delimiter = st.selectbox(
             "Delimitador",
-            [',', ';', '\t', ' '],
-            index=0, # Pode tentar adivinhar o index inicial com base no nome do ficheiro ou conteúdo se quiser
+            DELIMITERS,
             key="delimiter_selector",
             help="Escolha o delimitador usado no ficheiro"
         )
 
         try:
-            # Primeiro, ler um pouco do ficheiro para mostrar preview e selecionar colunas
-            # Usamos BytesIO e seek(0) para garantir que a leitura começa do início
-            file_buffer.seek(0)
-            # Tenta ler com o delimitador selecionado
-            try:
-                 # pd.read_csv pode ter problemas com encoding, usar 'latin1' ou 'cp1252' é comum para dados de instrumentos
-                 data_preview = pd.read_csv(file_buffer, delimiter=delimiter, nrows=10, encoding='utf-8')
-            except UnicodeDecodeError:
-                 file_buffer.seek(0) # Reset novamente para tentar outra encoding
-                 data_preview = pd.read_csv(file_buffer, delimiter=delimiter, nrows=10, encoding='latin1')
-
+            # Ler apenas as primeiras 10 linhas para preview e selecionar colunas;
+            # o ficheiro completo só é lido ao carregar em "Processar Cromatograma"
+            headerless = is_headerless_numeric(file_id, raw_bytes, delimiter, encoding)
+            if headerless:
+                data_preview = load_headerless_numeric(file_id, raw_bytes, delimiter, encoding, max_rows=10)
+                st.info(f"ℹ️ Ficheiro numérico sem cabeçalho: colunas nomeadas {HEADERLESS_COLUMNS}")
+            else:
+                data_preview = load_csv_preview(file_id, raw_bytes, delimiter, encoding)
 
             st.success(f"✅ Ficheiro carregado com sucesso! (Lidas primeiras 10 linhas para pré-visualização)")
 
-            # Mostrar preview dos dados
-            with st.expander("🔍 Pré-visualização dos dados e Informações"):
+            # Mostrar preview dos dados (só calculado quando pedido: o corpo de um st.expander corre sempre, mesmo fechado)
+            if st.checkbox("🔍 Mostrar pré-visualização dos dados e informações", value=False, key="show_preview_checkbox"):
                 st.dataframe(data_preview)
 
-                # Tentar ler o ficheiro completo para obter o número total de linhas e colunas
-                file_buffer.seek(0)
-                try:
-                    full_data_info = pd.read_csv(file_buffer, delimiter=delimiter, encoding='utf-8')
-                except UnicodeDecodeError:
-                    file_buffer.seek(0)
-                    full_data_info = pd.read_csv(file_buffer, delimiter=delimiter, encoding='latin1')
-
-
                 col1, col2 = st.columns(2)
                 with col1:
                     st.write("**Informações do dataset:**")
                     st.write(f"- Nome do ficheiro: {uploaded_file.name}")
                     st.write(f"- Tamanho do ficheiro: {uploaded_file.size} bytes")
-                    st.write(f"- Número de linhas (estimado): {full_data_info.shape[0]}")
-                    st.write(f"- Número de colunas: {full_data_info.shape[1]}")
-                    st.write(f"- Colunas: {list(full_data_info.columns)}")
+                    st.write(f"- Encoding detetado: {encoding}")
+                    st.write(f"- Número de linhas (estimado): {st.session_state.row_count + (1 if headerless else 0)}")
+                    st.write(f"- Número de colunas: {data_preview.shape[1]}")
+                    st.write(f"- Colunas: {list(data_preview.columns)}")
 
                 with col2:
                     st.write("**Estatísticas básicas (primeiras 10 linhas):**")
@@ -197,7 +686,7 @@ def main():
             # Selecionar colunas e unidade de tempo
             st.header("📋 Configuração das Colunas")
 
-            available_columns = full_data_info.columns.tolist() # Usar colunas do ficheiro completo
+            available_columns = data_preview.columns.tolist() # Colunas do cabeçalho do ficheiro
 
             if not available_columns:
                  st.error("Não foram detetadas colunas no ficheiro. Verifique o delimitador.")
@@ -205,21 +694,12 @@ def main():
 
             col1, col2, col3 = st.columns(3)
 
-            # Tentar pré-selecionar colunas comuns
-            default_time_col_index = 0
-            if 'time' in available_columns:
-                 default_time_col_index = available_columns.index('time')
-            elif 'tempo' in available_columns:
-                 default_time_col_index = available_columns.index('tempo')
-
-            default_signal_col_index = 1 if len(available_columns) > 1 else 0
-            if 'signal' in available_columns:
-                 default_signal_col_index = available_columns.index('signal')
-            elif 'sinal' in available_columns:
-                 default_signal_col_index = available_columns.index('sinal')
-            elif 'intensity' in available_columns:
-                 default_signal_col_index = available_columns.index('intensity')
-
+            # Tentar pré-selecionar colunas comuns (calculado só quando as colunas mudam)
+            columns_key = tuple(available_columns)
+            if st.session_state.get("default_columns_key") != columns_key:
+                st.session_state.default_columns_key = columns_key
+                st.session_state.default_column_indices = guess_default_columns(available_columns)
+            default_time_col_index, default_signal_col_index = st.session_state.default_column_indices
 
             with col1:
                 time_col = st.selectbox(
@@ -249,30 +729,39 @@ def main():
                 )
 
             # Botão para processar
+            # Os resultados são mostrados ao carregar no botão e voltam a ser calculados quando novos
+            # parâmetros são aplicados no formulário (para o mesmo ficheiro já processado)
             if st.button("🚀 Processar Cromatograma", type="primary", key="process_button"):
+                st.session_state.processed_file_id = file_id
+                show_results = True
+            else:
+                show_results = params_submitted and st.session_state.get("processed_file_id") == file_id
+
+            if show_results:
                 if not time_col or not signal_col:
                      st.warning("Por favor, selecione as colunas de Tempo e Sinal.")
                 else:
                     with st.spinner("Carregando e processando dados..."):
                         try:
-                            # Carregar o ficheiro completo usando o delimitador selecionado
-                            file_buffer.seek(0) # Reset buffer position
-                            try:
-                                data_df = pd.read_csv(file_buffer, delimiter=delimiter, encoding='utf-8')
-                            except UnicodeDecodeError:
-                                file_buffer.seek(0)
-                                data_df = pd.read_csv(file_buffer, delimiter=delimiter, encoding='latin1')
+                            # Carregar apenas as colunas de tempo e sinal usando o delimitador selecionado (cache)
+                            if headerless:
+                                data_df = load_headerless_numeric(file_id, raw_bytes, delimiter, encoding)
+                            else:
+                                data_df = load_full_csv(file_id, raw_bytes, delimiter, encoding, usecols=(time_col, signal_col))
 
                             # Converter tempo para minutos
                             data_df = convert_time_to_minutes(data_df, time_col, time_unit)
+                            if TIME_UNIT_TO_MINUTES.get(time_unit, 1.0) != 1.0:
+                                # Só há mensagem quando houve conversão (minutos ou unidade desconhecida: nada a converter)
+                                st.info(f"✅ Tempo convertido para minutos (unidade original: {time_unit.lower()})")
 
                             # --- Etapa de Processamento (se a biblioteca HPLC estiver disponível) ---
-                            cromatograma = None
                             dados_picos = pd.DataFrame()
 
                             if HPLC_LIB_AVAILABLE:
                                 # Chamar a função de processamento HPLC
-                                cromatograma, dados_picos = process_chromatogram_hplc(data_df, time_col, signal_col, params)
+                                # O fit usa sempre float64 contíguo (sem cópia se os dados já estiverem nesse formato)
+                                dados_picos = process_chromatogram_hplc(to_contiguous_float64(data_df, (time_col, signal_col)), time_col, signal_col, params)
                             else:
                                 st.warning("Biblioteca HPLC não disponível. A detecção de picos será ignorada.")
                                 # Criar um objeto Chromatogram básico para o gráfico se a lib não existir,
@@ -289,32 +778,38 @@ def main():
 
                             with col_graph:
                                 st.subheader("Cromatograma")
-                                fig, ax = plt.subplots(figsize=(12, 6))
 
                                 # Usar o DataFrame carregado para plotar
                                 if data_df is not None and time_col in data_df.columns and signal_col in data_df.columns:
-                                    ax.plot(data_df[time_col], data_df[signal_col], 'b-', linewidth=1)
-
-                                    # Se picos foram detectados, plotar os picos
-                                    if not dados_picos.empty and 'rt' in dados_picos.columns and 'height' in dados_picos.columns:
-                                         ax.plot(dados_picos['rt'], dados_picos['height'], 'ro', markersize=5, label='Picos Detetados')
-                                         ax.vlines(dados_picos['rt'], [0], dados_picos['height'], color='red', linestyle=':', linewidth=0.8)
-                                         ax.legend()
-
-
-                                    ax.set_xlabel(f'{time_col} ({data_df[time_col].dtype})') # Mostrar tipo de dado
-                                    ax.set_ylabel(f'{signal_col} ({data_df[signal_col].dtype})') # Mostrar tipo de dado
+                                    time_values = data_df[time_col].to_numpy()
+                                    signal_values = data_df[signal_col].to_numpy()
+                                    if len(data_df) > PLOT_DECIMATION_THRESHOLD:
+                                        # Uma figura tem poucos milhares de píxeis de largura: desenhar todos os pontos é desperdício
+                                        time_values, signal_values = decimate_min_max(time_values, signal_values)
+
+                                    x_label = f'{time_col} ({data_df[time_col].dtype})' # Mostrar tipo de dado
+                                    y_label = f'{signal_col} ({data_df[signal_col].dtype})' # Mostrar tipo de dado
+
+                                    if high_quality_png:
+                                        fig = plot_chromatogram_matplotlib(time_values, signal_values, dados_picos, x_label, y_label)
+                                        st.pyplot(fig)
+                                        png_buffer = io.BytesIO()
+                                        fig.savefig(png_buffer, format='png', dpi=300, bbox_inches='tight')
+                                        plt.close(fig) # Fecha a figura para liberar memória
+                                        st.download_button(
+                                            label="🖼️ Transferir gráfico (PNG)",
+                                            data=png_buffer.getvalue(),
+                                            file_name="cromatograma.png",
+                                            mime="image/png",
+                                            key="download_plot_button"
+                                        )
+                                    else:
+                                        # Gráfico desenhado no browser: sem rasterização nem codificação PNG no servidor
+                                        chart = plot_chromatogram_altair(time_values, signal_values, dados_picos, x_label, y_label)
+                                        st.altair_chart(chart, width="stretch")
                                 else:
-                                     ax.set_xlabel("Tempo")
-                                     ax.set_ylabel("Sinal")
                                      st.error("Não foi possível plotar o cromatograma. Verifique as colunas e os dados.")
 
-
-                                ax.set_title('Cromatograma com Picos Detetados')
-                                ax.grid(True, alpha=0.3)
-                                st.pyplot(fig)
-                                plt.close(fig) # Fecha a figura para liberar memória
-
                             with col_info:
                                 st.subheader("Informações dos Picos")
                                 if HPLC_LIB_AVAILABLE:
@@ -325,10 +820,9 @@ def main():
                                         st.dataframe(dados_picos)
 
                                         # Opção para download
-                                        csv = dados_picos.to_csv(index=False)
                                         st.download_button(
                                             label="💾 Transferir dados dos picos (CSV)",
-                                            data=csv,
+                                            data=peaks_to_csv_bytes(dados_picos),
                                             file_name="picos_detectados.csv",
                                             mime="text/csv",
                                             key="download_peaks_button"
@@ -336,22 +830,25 @@ def main():
 
                                         # Estatísticas dos picos
                                         st.subheader("📈 Estatísticas dos Picos")
-                                        if 'height' in dados_picos.columns and 'area' in dados_picos.columns:
+                                        if PEAK_HEIGHT_COL in dados_picos.columns and 'area' in dados_picos.columns:
+                                            # Todas as estatísticas numa única agregação
+                                            peak_stats = dados_picos[[PEAK_HEIGHT_COL, 'area']].agg(['min', 'max', 'mean', 'sum'])
+
                                             col_h1, col_h2, col_h3 = st.columns(3)
                                             with col_h1:
-                                                st.metric("Altura média", f"{dados_picos['height'].mean():,.3f}")
+                                                st.metric("Altura média", f"{peak_stats.loc['mean', PEAK_HEIGHT_COL]:,.3f}")
                                             with col_h2:
-                                                st.metric("Altura máxima", f"{dados_picos['height'].max():,.3f}")
+                                                st.metric("Altura máxima", f"{peak_stats.loc['max', PEAK_HEIGHT_COL]:,.3f}")
                                             with col_h3:
-                                                st.metric("Altura mínima", f"{dados_picos['height'].min():,.3f}")
+                                                st.metric("Altura mínima", f"{peak_stats.loc['min', PEAK_HEIGHT_COL]:,.3f}")
 
                                             col_a1, col_a2, col_a3 = st.columns(3)
                                             with col_a1:
-                                                st.metric("Área Total", f"{dados_picos['area'].sum():,.3f}")
+                                                st.metric("Área Total", f"{peak_stats.loc['sum', 'area']:,.3f}")
                                             with col_a2:
-                                                st.metric("Área média", f"{dados_picos['area'].mean():,.3f}")
+                                                st.metric("Área média", f"{peak_stats.loc['mean', 'area']:,.3f}")
                                             with col_a3:
-                                                st.metric("Área máxima", f"{dados_picos['area'].max():,.3f}")
+                                                st.metric("Área máxima", f"{peak_stats.loc['max', 'area']:,.3f}")
 
                                     else:
                                         st.warning("Nenhum pico foi detectado com os parâmetros atuais.")
@@ -360,14 +857,12 @@ def main():
 
 
                         except Exception as e:
-                            st.error(f"❌ Ocorreu um erro durante o processamento dos dados: {str(e)}")
-                            st.exception(e)
+                            show_error("Ocorreu um erro durante o processamento dos dados", e)
 
 
         except Exception as e:
-            st.error(f"❌ Erro ao ler o ficheiro com o delimitador '{delimiter}': {str(e)}")
+            show_error(f"Erro ao ler o ficheiro com o delimitador '{delimiter}'", e)
             st.info("💡 Tente ajustar o delimitador ou verificar se o ficheiro é realmente CSV/DAT compatível.")
-            st.exception(e)
 
     else:
         st.info("👆 Por favor, carregue um ficheiro CSV ou DAT para começar a análise.")